@@ -1,34 +1,82 @@
+import csv
 import io
+import re
 import datetime as dt
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
+try:
+    import pyarrow  # noqa: F401
+    _HAS_PYARROW = True
+except ImportError:
+    _HAS_PYARROW = False
+
 
 # ---------- Fonctions utilitaires ----------
 
-def lire_fec(uploaded_file) -> pd.DataFrame:
-    """Lit un FEC en devinant le séparateur le plus probable."""
-    filename = uploaded_file.name.lower()
+# Normalisation des montants en un seul passage : espaces (y compris
+# insécables des exports français) supprimés, virgule décimale -> point
+_AMOUNT_TRANS = str.maketrans({" ": "", "\xa0": "", ",": "."})
+
+def _detecter_format_date(serie: pd.Series) -> str:
+    """Détecte le format de date du FEC (AAAAMMJJ ou AAAA-MM-JJ) sur la
+    première valeur non vide ; 'mixed' sinon."""
+    non_vides = serie.dropna()
+    if not non_vides.empty:
+        premier = str(non_vides.iat[0])
+        if re.fullmatch(r"\d{8}", premier):
+            return "%Y%m%d"
+        if re.fullmatch(r"\d{4}-\d{2}-\d{2}", premier):
+            return "%Y-%m-%d"
+    return "mixed"
+
+
+def _read_csv_rapide(content: bytes, sep: str) -> pd.DataFrame:
+    """Lit un CSV en mémoire, via PyArrow si disponible (tokenisation C++,
+    colonnes texte sans objets Python), sinon via le moteur C de pandas."""
+    if _HAS_PYARROW:
+        try:
+            return pd.read_csv(
+                io.BytesIO(content),
+                sep=sep,
+                dtype=str,
+                engine="pyarrow",
+                dtype_backend="pyarrow",
+            )
+        except Exception:
+            pass  # options non supportées par pyarrow -> moteur C
+    return pd.read_csv(io.BytesIO(content), sep=sep, dtype=str, engine="c")
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def lire_fec(file_bytes: bytes, filename: str) -> pd.DataFrame:
+    """Lit un FEC en devinant le séparateur le plus probable.
+
+    Mis en cache sur les octets du fichier : les reruns Streamlit
+    (changement de date, choix d'un client) ne re-parsent pas le FEC.
+    """
+    filename = filename.lower()
 
     if filename.endswith(".xlsx") or filename.endswith(".xls"):
-        df = pd.read_excel(uploaded_file, dtype=str)
+        df = pd.read_excel(io.BytesIO(file_bytes), dtype=str)
     else:
-        # Essais successifs de séparateurs classiques
-        content = uploaded_file.read()
-        for sep in [";", "\t", ",", "|"]:
-            try:
-                df = pd.read_csv(
-                    io.BytesIO(content),
-                    sep=sep,
-                    dtype=str,
-                    engine="python",
-                )
-                # Si on a au moins 5 colonnes, on considère que c'est bon
-                if df.shape[1] >= 5:
-                    break
-            except Exception:
-                df = None
+        # Détection du séparateur sur un échantillon, puis une seule lecture (moteur C)
+        content = file_bytes
+        sample = content[:65536].decode("utf-8", errors="replace")
+        try:
+            sep = csv.Sniffer().sniff(sample, delimiters=";\t,|").delimiter
+        except csv.Error:
+            sep = ";"
+        try:
+            df = _read_csv_rapide(content, sep)
+            # Garde-fou : si on ne voit qu'une colonne alors que ';' est présent,
+            # le sniffer s'est trompé, on retente avec ';'
+            if df.shape[1] == 1 and sep != ";" and ";" in sample:
+                df = _read_csv_rapide(content, ";")
+        except Exception:
+            df = None
         if df is None:
             st.error("Impossible de lire le fichier. Merci de vérifier le séparateur.")
             st.stop()
@@ -39,19 +87,28 @@ def lire_fec(uploaded_file) -> pd.DataFrame:
     # Conversion des montants
     for col in ["Debit", "Credit"]:
         if col in df.columns:
-            df[col] = (
-                df[col]
-                .str.replace(" ", "", regex=False)
-                .str.replace(",", ".", regex=False)
-                .astype(float)
+            # float64 obligatoire : au-delà de 65 536 € le pas du float32
+            # (~0,008 €) ne représente plus les centimes et fausse les soldes
+            df[col] = pd.to_numeric(
+                df[col].str.translate(_AMOUNT_TRANS), errors="coerce"
             )
         else:
             st.error(f"Colonne manquante dans le FEC : {col}")
             st.stop()
 
-    # Conversion des dates
+    # Colonnes très répétitives en catégorie : le filtre 411* ne balaie que
+    # les valeurs uniques, et le groupby hache des petits entiers plutôt que
+    # quatre chaînes Python par ligne
+    for col in ("CompteNum", "CompteLib", "CompAuxNum", "CompAuxLib", "PieceRef"):
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+
+    # Conversion des dates : format explicite quand il est reconnaissable
+    # (chemin C vectorisé, ~50x plus rapide que le parsing ligne à ligne)
     if "PieceDate" in df.columns:
-        df["PieceDate"] = pd.to_datetime(df["PieceDate"], errors="coerce")
+        df["PieceDate"] = pd.to_datetime(
+            df["PieceDate"], format=_detecter_format_date(df["PieceDate"]), errors="coerce"
+        )
     else:
         st.error("Colonne 'PieceDate' manquante dans le FEC.")
         st.stop()
@@ -59,6 +116,7 @@ def lire_fec(uploaded_file) -> pd.DataFrame:
     return df
 
 
+@st.cache_data(show_spinner=False)
 def calc_creances_ouvertes(df: pd.DataFrame, date_anciennete: dt.date) -> pd.DataFrame:
     """
     Calcule les créances clientes ouvertes par facture (PieceRef)
@@ -72,25 +130,54 @@ def calc_creances_ouvertes(df: pd.DataFrame, date_anciennete: dt.date) -> pd.Dat
     - Règlement partiel = Montant facture - Solde
     - On garde uniquement les soldes non nuls et les pièces antérieures à date_anciennete
     """
-    df = df.copy()
+    # On ne travaille que sur les colonnes utiles (vue, pas de copie du FEC)
+    cols = [
+        "CompteNum", "CompteLib", "CompAuxNum", "CompAuxLib",
+        "PieceRef", "PieceDate", "Debit", "Credit",
+    ]
+    df = df[[c for c in cols if c in df.columns]]
 
     # Filtre comptes clients (tu peux élargir à 410 / 418 si besoin)
-    df["CompteNum"] = df["CompteNum"].astype(str)
-    mask_clients = df["CompteNum"].str.startswith("411")
-    df_clients = df[mask_clients].copy()
+    # Le test de préfixe se fait sur les valeurs uniques de la catégorie,
+    # puis est propagé aux lignes via les codes entiers
+    if not isinstance(df["CompteNum"].dtype, pd.CategoricalDtype):
+        df["CompteNum"] = df["CompteNum"].astype("category")
+    good = np.asarray(df["CompteNum"].cat.categories.astype(str).str.startswith("411"))
+    # Aucun compte 411 parmi les valeurs uniques : inutile de construire
+    # le masque ligne à ligne, on sort tout de suite
+    if not good.any():
+        st.warning("Aucune écriture de compte 411* trouvée dans le FEC.")
+        return pd.DataFrame()
+    # Les codes -1 (valeurs manquantes) pointent sur ce False sentinelle
+    good = np.append(good, False)
+    mask_clients = good[df["CompteNum"].cat.codes.to_numpy()]
+    df_clients = df.loc[mask_clients]
 
     if df_clients.empty:
         st.warning("Aucune écriture de compte 411* trouvée dans le FEC.")
         return pd.DataFrame()
 
-    # Colonne Solde par ligne
-    df_clients["Solde_ligne"] = df_clients["Debit"] - df_clients["Credit"]
+    # PieceDate fait partie de la clé de regroupement : les lignes au-delà
+    # de la date d'ancienneté ne peuvent produire aucune pièce retenue,
+    # autant les écarter avant le groupby
+    cutoff = pd.Timestamp(date_anciennete) + pd.Timedelta(days=1)
+    df_clients = df_clients.loc[(df_clients["PieceDate"] < cutoff).to_numpy()]
+
+    if df_clients.empty:
+        st.warning(
+            "Aucune écriture client antérieure au "
+            f"{date_anciennete.strftime('%d/%m/%Y')} trouvée dans le FEC."
+        )
+        return pd.DataFrame()
 
     # Si pas de compte auxiliaire, on remplace par compte général
+    auxiliaires = {}
     if "CompAuxNum" not in df_clients.columns:
-        df_clients["CompAuxNum"] = df_clients["CompteNum"]
+        auxiliaires["CompAuxNum"] = df_clients["CompteNum"]
     if "CompAuxLib" not in df_clients.columns:
-        df_clients["CompAuxLib"] = df_clients["CompteLib"]
+        auxiliaires["CompAuxLib"] = df_clients["CompteLib"]
+    if auxiliaires:
+        df_clients = df_clients.assign(**auxiliaires)
 
     group_cols = [
         "CompAuxNum",
@@ -103,24 +190,31 @@ def calc_creances_ouvertes(df: pd.DataFrame, date_anciennete: dt.date) -> pd.Dat
         st.error("La colonne 'PieceRef' est manquante dans le FEC. On en a besoin pour identifier les factures.")
         st.stop()
 
-    grp = df_clients.groupby(group_cols, dropna=False)
-
-    synthese = grp.agg(
-        Montant_facture=("Debit", "sum"),
-        Total_credit=("Credit", "sum"),
-        Solde=("Solde_ligne", "sum"),
-    ).reset_index()
+    # Une seule passe de somme sur les deux colonnes (le tri est fait plus bas) ;
+    # la somme étant linéaire, Solde = somme(Débit) - somme(Crédit)
+    synthese = (
+        df_clients.groupby(group_cols, dropna=False, sort=False, observed=True)[
+            ["Debit", "Credit"]
+        ]
+        .sum()
+        .rename(columns={
+            "Debit": "Montant_facture",
+            "Credit": "Total_credit",
+        })
+        .reset_index()
+    )
+    synthese["Solde"] = synthese["Montant_facture"] - synthese["Total_credit"]
 
-    # Nettoyage
-    synthese["Solde"] = synthese["Solde"].round(2)
-    synthese["Montant_facture"] = synthese["Montant_facture"].round(2)
-    synthese["Total_credit"] = synthese["Total_credit"].round(2)
+    # Nettoyage : un seul kernel d'arrondi pour les trois colonnes
+    montants = ["Montant_facture", "Total_credit", "Solde"]
+    synthese[montants] = np.round(synthese[montants].to_numpy(), 2)
 
     # Règlement partiel = montant payé sur cette facture
-    synthese["Reglement_partiel"] = (synthese["Montant_facture"] - synthese["Solde"]).clip(lower=0).round(2)
-
-    # Filtre : pièces antérieures à la date d'ancienneté
-    synthese = synthese[synthese["PieceDate"].dt.date <= date_anciennete]
+    # (soustraction, plancher et arrondi enchaînés en place sur un seul tampon)
+    diff = synthese["Montant_facture"].to_numpy() - synthese["Solde"].to_numpy()
+    np.maximum(diff, 0, out=diff)
+    np.round(diff, 2, out=diff)
+    synthese["Reglement_partiel"] = diff
 
     # On garde seulement les factures encore ouvertes (solde != 0)
     synthese = synthese[synthese["Solde"].abs() > 0.01]
@@ -128,43 +222,45 @@ def calc_creances_ouvertes(df: pd.DataFrame, date_anciennete: dt.date) -> pd.Dat
     # Tri par client puis date
     synthese = synthese.sort_values(["CompAuxNum", "PieceDate", "PieceRef"])
 
+    # Dates affichables pré-formatées une fois pour toutes : le rendu
+    # par client se contente de découper cette colonne
+    synthese["PieceDate_str"] = synthese["PieceDate"].dt.strftime("%d/%m/%Y")
+
     return synthese
 
 
+@st.cache_data(show_spinner=False)
+def _index_par_client(df_ouvert: pd.DataFrame) -> dict:
+    """Découpe les créances ouvertes par client une fois pour toutes :
+    la sélection d'un client devient une simple recherche de dictionnaire."""
+    return {
+        code: sous_df
+        for code, sous_df in df_ouvert.groupby("CompAuxNum", sort=False, observed=True)
+    }
+
+
 def fabriquer_tableau_client(df_ouvert: pd.DataFrame, client_code: str) -> pd.DataFrame:
     """Construit le tableau à envoyer par mail pour un client donné."""
-    df_client = df_ouvert[df_ouvert["CompAuxNum"] == client_code].copy()
+    df_client = _index_par_client(df_ouvert).get(client_code, df_ouvert.iloc[:0])
     if df_client.empty:
         return df_client
 
-    df_client["PieceDate"] = df_client["PieceDate"].dt.strftime("%d/%m/%Y")
-
-    # Colonnes à envoyer au client + colonnes à renseigner
-    df_client = df_client[[
-        "PieceDate",
-        "PieceRef",
-        "Montant_facture",
-        "Reglement_partiel",
-        "Solde",
-    ]]
-
-    df_client = df_client.rename(columns={
-        "PieceDate": "Date facture",
-        "PieceRef": "Référence facture",
-        "Montant_facture": "Montant facture TTC",
-        "Reglement_partiel": "Règlement(s) déjà reçu(s)",
-        "Solde": "Solde restant dû",
+    # Colonnes à envoyer au client + colonnes à renseigner,
+    # construites directement depuis la vue (pas de copie/rename)
+    return pd.DataFrame({
+        "Date facture": df_client["PieceDate_str"].to_numpy(),
+        "Référence facture": df_client["PieceRef"].to_numpy(),
+        "Montant facture TTC": df_client["Montant_facture"].to_numpy(),
+        "Règlement(s) déjà reçu(s)": df_client["Reglement_partiel"].to_numpy(),
+        "Solde restant dû": df_client["Solde"].to_numpy(),
+        # Colonnes que le client devra compléter
+        "Créance douteuse ? (Oui/Non)": "",
+        "Si douteuse, montant ou % douteux": "",
+        "Manque-t-il un avoir ? (Oui/Non)": "",
+        "Si payé, date de règlement": "",
+        "Commentaires (client)": "",
     })
 
-    # Colonnes que le client devra compléter
-    df_client["Créance douteuse ? (Oui/Non)"] = ""
-    df_client["Si douteuse, montant ou % douteux"] = ""
-    df_client["Manque-t-il un avoir ? (Oui/Non)"] = ""
-    df_client["Si payé, date de règlement"] = ""
-    df_client["Commentaires (client)"] = ""
-
-    return df_client
-
 
 def proposer_mail(client_name: str,
                   client_code: str,
@@ -221,7 +317,8 @@ uploaded_file = st.file_uploader(
 )
 
 if uploaded_file is not None:
-    df_fec = lire_fec(uploaded_file)
+    file_bytes = uploaded_file.read()
+    df_fec = lire_fec(file_bytes, uploaded_file.name)
 
     st.success("FEC importé avec succès ✅")
 
@@ -238,8 +335,16 @@ if uploaded_file is not None:
             help="Seules les factures avec une date pièce antérieure ou égale à cette date seront retenues.",
         )
 
-    # Calcul des créances ouvertes
-    df_ouvert = calc_creances_ouvertes(df_fec, date_anciennete=date_anciennete)
+    # Calcul des créances ouvertes, gardé en session : le choix d'un client
+    # dans la liste déroulante ne relance rien tant que (fichier, date
+    # d'ancienneté) ne change pas
+    cle_calcul = (hash(file_bytes), date_anciennete.isoformat())
+    if st.session_state.get("cle_calcul") != cle_calcul:
+        st.session_state["df_ouvert"] = calc_creances_ouvertes(
+            df_fec, date_anciennete=date_anciennete
+        )
+        st.session_state["cle_calcul"] = cle_calcul
+    df_ouvert = st.session_state["df_ouvert"]
 
     if df_ouvert.empty:
         st.info("Aucune créance ouverte trouvée selon les critères définis.")
@@ -252,18 +357,18 @@ if uploaded_file is not None:
     )
     st.dataframe(df_ouvert.head(100), use_container_width=True)
 
-    # Choix du client
-    clients = (
-        df_ouvert[["CompAuxNum", "CompAuxLib"]]
-        .drop_duplicates()
-        .sort_values("CompAuxNum")
-    )
+    # Choix du client : un libellé par code, sans dédoublonner ligne à ligne
+    libelles_clients = df_ouvert.groupby("CompAuxNum", sort=True, observed=True)[
+        "CompAuxLib"
+    ].first()
 
     st.subheader("Préparation du mail par client")
-    client_labels = {
-        f"{row.CompAuxNum} - {row.CompAuxLib}": row.CompAuxNum
-        for row in clients.itertuples()
-    }
+    # Extraction NumPy en bloc : pas d'itération pandas valeur par valeur
+    codes_clients = np.asarray(libelles_clients.index)
+    libs_clients = libelles_clients.to_numpy()
+    client_labels = dict(
+        zip((f"{c} - {l}" for c, l in zip(codes_clients, libs_clients)), codes_clients)
+    )
 
     choix_label = st.selectbox(
         "Sélectionner un client",
@@ -272,7 +377,7 @@ if uploaded_file is not None:
 
     if choix_label:
         client_code = client_labels[choix_label]
-        client_name = clients.loc[clients["CompAuxNum"] == client_code, "CompAuxLib"].iloc[0]
+        client_name = _index_par_client(df_ouvert)[client_code]["CompAuxLib"].iat[0]
 
         # Tableau spécifique à ce client
         df_client_mail = fabriquer_tableau_client(df_ouvert, client_code)
@@ -285,7 +390,17 @@ if uploaded_file is not None:
 
             # Export Excel pour pièce jointe
             buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+            # Pas d'URL ni de formule dans ces données : inutile de payer la
+            # détection cellule par cellule (constant_memory est incompatible
+            # avec l'écriture colonne par colonne de to_excel)
+            with pd.ExcelWriter(
+                buffer,
+                engine="xlsxwriter",
+                engine_kwargs={"options": {
+                    "strings_to_urls": False,
+                    "strings_to_formulas": False,
+                }},
+            ) as writer:
                 df_client_mail.to_excel(writer, index=False, sheet_name="Relance client")
             buffer.seek(0)
 